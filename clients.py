@@ -0,0 +1,24 @@
+# ==============================================================================
+# SHARED GOOGLE CLOUD CLIENT FACTORY
+# ==============================================================================
+# The three QBO ETL scripts each built their own BigQuery client at import
+# time, paying the service-account OAuth exchange (~300-500 ms) once per
+# script. When they run together in one process, the memoized factory below
+# hands every caller the same client — one token exchange, one shared HTTP
+# connection pool.
+from functools import lru_cache
+
+from google.api_core.client_info import ClientInfo
+from google.cloud import bigquery
+
+# Service-account key shared by all three scripts (they run from the repo root).
+BQ_KEY_PATH = 'we_are_hipaa_smart_google_key.json'
+
+
+@lru_cache(maxsize=1)
+def get_bq():
+    """Returns the process-wide BigQuery client (built on first call)."""
+    return bigquery.Client.from_service_account_json(
+        BQ_KEY_PATH,
+        client_info=ClientInfo(user_agent='wahs-etl/1'),
+    )
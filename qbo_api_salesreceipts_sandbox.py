@@ -1,12 +1,21 @@
 # ==============================================================================
 # 0. IMPORTS AND INITIAL CONFIGURATION
 # ==============================================================================
-import json
+import orjson
+import re
 import requests
 import pandas as pd
-from google.cloud import bigquery 
+import pyarrow as pa
+import pyarrow.compute as pc
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import bigquery
 import os
-import sys 
+import sys
+
+# Copy-on-Write: column selections share memory with their parent frame until
+# written to — no defensive .copy() needed anywhere below.
+pd.set_option('mode.copy_on_write', True)
 
 # --- Required Intuit Libraries (for token management) ---
 from intuitlib.client import AuthClient 
@@ -14,13 +23,16 @@ from intuitlib.client import AuthClient
 # because of the ModuleNotFoundError, but we keep the import if you want to fix it later.
 from quickbooks.client import QuickBooks 
 
+# --- Shared BigQuery client factory ---
+from clients import get_bq
+
 # --- Configuration File ---
 CONFIG_FILE = 'qbo_config.json'
 
 # Load credentials
 try:
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.load(f)
+    with open(CONFIG_FILE, 'rb') as f:
+        config = orjson.loads(f.read())
 except FileNotFoundError:
     print(f"❌ ERROR: Config file '{CONFIG_FILE}' not found. Please create it.")
     sys.exit(1)
@@ -46,8 +58,8 @@ try:
     new_refresh_token = auth_client.refresh_token
     if new_refresh_token != config['refresh_token']:
         config['refresh_token'] = new_refresh_token
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        with open(CONFIG_FILE, 'wb') as f:
+            f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
         print("✅ New Refresh Token successfully saved.")
 
 except Exception as e:
@@ -61,16 +73,32 @@ env_base = "https://sandbox-quickbooks.api.intuit.com" if ENV == 'sandbox' else
 TARGET_PRODUCT = 'We Are, HIPAA Smart'
 TARGET_PRODUCT = TARGET_PRODUCT.strip() 
 
+_WS_RE = re.compile(r'\s+')
+
 def clean_and_lower(text):
-    if pd.isna(text): return None
+    if text is None: return None
     # Replace all whitespace characters (spaces, tabs, newlines, etc.) with a single space, then lower.
-    return ' '.join(str(text).split()).lower()
+    return _WS_RE.sub(' ', str(text)).strip().lower()
 
 # Apply this cleaning to your target:
 TARGET_PRODUCT_CLEAN = clean_and_lower(TARGET_PRODUCT) 
 
 print("✅ QBO Client authenticated and tokens refreshed.")
 
+# One pooled keep-alive session for every page request: a single TLS
+# handshake amortized over the run, plus automatic backoff on QBO 429s/5xx.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+SESSION.headers.update({
+    'Authorization': f'Bearer {access_token}',
+    'Accept': 'application/json',
+    'Content-Type': 'application/x-www-form-urlencoded'
+})
+
 
 # ==============================================================================
 # 2. QBO DATA EXTRACTION (E) - CORRECTED
@@ -81,8 +109,10 @@ def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_nam
     start_pos = 1
     max_results = 1000
     
+    # Explicit column list mirroring QBO_RECEIPT_SCHEMA — everything else
+    # would be parsed and immediately dropped at the Arrow boundary anyway.
     qbo_base_query = (
-        f"SELECT * FROM SalesReceipt "
+        f"SELECT Id, TxnDate, TotalAmt, CustomerRef, Line FROM SalesReceipt "
     )
     
     # --- FIX 2: Corrected print statement ---
@@ -92,17 +122,7 @@ def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_nam
         qbo_query = f"{qbo_base_query} STARTPOSITION {start_pos} MAXRESULTS {max_results}"
         api_url = f"{base_url}/v3/company/{company_id}/query"
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept': 'application/json',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-
-        response = requests.get(
-            api_url, 
-            headers=headers, 
-            params={'query': qbo_query}
-        )
+        response = SESSION.get(api_url, params={'query': qbo_query})
         
         if response.status_code != 200:
             print("\n🚨 API REQUEST FAILED DETAILS 🚨")
@@ -111,7 +131,9 @@ def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_nam
             print("-----------------------------------")
             raise Exception("QBO API Request Failed.")
 
-        data = response.json()
+        # orjson parses the (potentially multi-MB) page body in native code,
+        # several times faster than requests' stdlib-json .json() helper.
+        data = orjson.loads(response.content)
         
         # --- FIX 1: Extract SalesReceipts, NOT Invoices ---
         receipts = data.get('QueryResponse', {}).get('SalesReceipt', [])
@@ -125,81 +147,85 @@ def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_nam
 
     # --- FIX 2: Corrected print statement ---
     print(f"✅ Extraction complete. Total {len(all_records)} Sales Receipt records found.")
-    return pd.DataFrame(all_records)
-
-def get_item_name(line):
-    """Safely extracts and strips whitespace from the item name."""
-    if isinstance(line, dict) and line.get('SalesItemLineDetail'):
-        name = line['SalesItemLineDetail'].get('ItemRef', {}).get('name')
-        if name:
-            return str(name).strip() # <--- CRITICAL: Strips whitespace
-    return None
+    return all_records
 
 
 #  ==============================================================================
 # 3. EXECUTION AND TRANSFORMATION (E & T)
 # ==============================================================================
 
-# --- EXECUTION (This runs first, creating df_receipts_raw) ---
-df_receipts_raw = fetch_qbo_sales_receipts_raw(access_token, company_id, env_base, TARGET_PRODUCT) 
+# --- EXECUTION (This runs first, creating receipts_raw) ---
+receipts_raw = fetch_qbo_sales_receipts_raw(access_token, company_id, env_base, TARGET_PRODUCT)
 
 
 # --- TRANSFORMATION STARTS HERE ---
-
-if df_receipts_raw.empty:
+# The whole explode + per-line item-name walk now runs inside Arrow:
+# list_flatten/list_parent_indices replace DataFrame.explode, struct_field
+# digs out the nested names, and the case/whitespace-folded comparison is a
+# single C pass instead of a Python call per line item.
+
+FINAL_COLS = ['sales_receipt_id', 'customer_name', 'transaction_date', 'product_name', 'line_amount']
+
+# Explicit Arrow schema for the fields we actually read. from_pylist infers
+# types by sampling otherwise, so a page where (say) no line has a Qty would
+# change the shape run-to-run and break the struct_field paths below. Pinning
+# the schema also drops every unused QBO field at parse time. TxnDate stays a
+# string; pd.to_datetime handles the parse where it's needed.
+QBO_RECEIPT_SCHEMA = pa.schema([
+    ('Id', pa.string()),
+    ('TxnDate', pa.string()),
+    ('TotalAmt', pa.float64()),
+    ('CustomerRef', pa.struct([('value', pa.string()), ('name', pa.string())])),
+    ('Line', pa.list_(pa.struct([
+        ('Amount', pa.float64()),
+        ('SalesItemLineDetail', pa.struct([
+            ('ItemRef', pa.struct([('value', pa.string()), ('name', pa.string())])),
+            ('Qty', pa.float64()),
+            ('UnitPrice', pa.float64()),
+        ])),
+    ]))),
+])
+
+if not receipts_raw:
     print("⚠️ WARNING: No Sales Receipts found in the QBO Sandbox. Loading 0 rows to BQ.")
-    df_payments_final = pd.DataFrame(columns=['sales_receipt_id', 'customer_name', 'transaction_date', 'product_name', 'line_amount'])
+    df_payments_final = pd.DataFrame(columns=FINAL_COLS)
 
 else:
-    # 1. Flatten Header Data
-    df_receipts_raw['customer_name'] = df_receipts_raw['CustomerRef'].apply(
-        lambda x: x.get('name') if isinstance(x, dict) else None
+    tbl = pa.Table.from_pylist(receipts_raw, schema=QBO_RECEIPT_SCHEMA)
+
+    # 1. Flatten line items (explode) and remember which receipt each came from
+    lines = tbl['Line'].combine_chunks()
+    flat_lines = pc.list_flatten(lines)
+    parent_idx = pc.list_parent_indices(lines)
+
+    # 2. Extract item names and apply the case-insensitive filter in C
+    item_names = pc.struct_field(flat_lines, ['SalesItemLineDetail', 'ItemRef', 'name'])
+    item_names_clean = pc.utf8_lower(
+        pc.utf8_trim_whitespace(pc.replace_substring_regex(item_names, r'\s+', ' '))
     )
-    df_receipts_raw['transaction_date'] = pd.to_datetime(
-        df_receipts_raw['TxnDate'], errors='coerce'
-    ).dt.date
+    product_mask = pc.fill_null(pc.equal(item_names_clean, TARGET_PRODUCT_CLEAN), False)
 
-    # 2. Explode the line items (Creates df_lines)
-    df_lines = df_receipts_raw.explode('Line', ignore_index=True)
+    matched_lines = pc.filter(flat_lines, product_mask)
+
+    if len(matched_lines) == 0:
+        print(f"⚠️ WARNING: Filtered result is EMPTY after checking for product '{TARGET_PRODUCT}'.")
+        df_payments_final = pd.DataFrame(columns=FINAL_COLS)
 
-    # 3. Extract Item Name
-    df_lines['item_name'] = df_lines['Line'].apply(get_item_name)
-    
-    # --- STEP 2: THE CASE-INSENSITIVE FILTER GOES HERE ---
-    
-    # 4. Apply Case-Insensitive Filter
-    
-    # Convert target product name and item names to lowercase for comparison
-    target_lower = TARGET_PRODUCT.lower()
-    df_lines['item_name_lower'] = df_lines['item_name'].apply(clean_and_lower)
-    df_product_lines = df_lines[df_lines['item_name_lower'] == TARGET_PRODUCT_CLEAN].copy()
-    
-    # Check if the filtered result is empty (critical check after filtering)
-    if df_product_lines.empty:
-        print(f"⚠️ WARNING: Filtered DataFrame is EMPTY after checking for product '{TARGET_PRODUCT}'.")
-        df_payments_final = pd.DataFrame(columns=['sales_receipt_id', 'customer_name', 'transaction_date', 'product_name', 'line_amount'])
-        
     else:
-        # 5. Final Selection and Rename
-        
-        # --- Safely find the amount key (either 'Amount' or 'amount') ---
-        # Assuming the amount key is 'Amount' (capital A) based on QBO JSON structure 
-        # for line items. If this fails, the error will tell you the exact name.
-        amount_key = 'amount' 
-        
-        df_payments_final = df_product_lines[[
-            'Id', # Sales Receipt ID
-            'customer_name',
-            'transaction_date',
-            'item_name',  
-            amount_key, 
-        ]].rename(columns={
-            'Id': 'sales_receipt_id', 
-            amount_key: 'line_amount',
-            'item_name': 'product_name' 
+        # 3. Pull the matching receipt headers back via the parent indices
+        headers = tbl.take(pc.filter(parent_idx, product_mask))
+
+        df_payments_final = pd.DataFrame({
+            'sales_receipt_id': headers['Id'].to_pylist(),
+            'customer_name': pc.struct_field(headers['CustomerRef'].combine_chunks(), 'name').to_pylist(),
+            'transaction_date': pd.to_datetime(headers['TxnDate'].to_pylist(), errors='coerce').date,
+            'product_name': pc.utf8_trim_whitespace(
+                pc.struct_field(matched_lines, ['SalesItemLineDetail', 'ItemRef', 'name'])
+            ).to_pylist(),
+            'line_amount': pc.struct_field(matched_lines, 'Amount').to_pylist(),
         })
-        
-        # 6. Final Cleaning
+
+        # Final Cleaning (Ensure numeric conversion)
         df_payments_final['line_amount'] = pd.to_numeric(
             df_payments_final['line_amount'], errors='coerce'
         )
@@ -212,10 +238,12 @@ print("✅ Data transformation complete.")
 # ==============================================================================
 
 # --- BigQuery Credentials ---
-BQ_KEY_PATH = 'we_are_hipaa_smart_google_key.json' 
+# The key path lives in clients.py alongside the shared factory.
 
 try:
-    bq_client = bigquery.Client.from_service_account_json(BQ_KEY_PATH) 
+    # Memoized factory: in a combined pipeline run all three scripts share a
+    # single authenticated client (and its HTTP pool).
+    bq_client = get_bq()
     print("✅ BigQuery Client authenticated.")
 except Exception as e:
     print(f"❌ BigQuery Authentication Failed. Check key path/content: {e}")
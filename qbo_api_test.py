@@ -1,10 +1,14 @@
 # ==============================================================================
 # 0. IMPORTS AND INITIAL CONFIGURATION
 # ==============================================================================
-import json
+import math
+import orjson
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import bigquery 
+from google.cloud import secretmanager
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys 
 
@@ -14,17 +18,59 @@ from intuitlib.client import AuthClient
 # because of the ModuleNotFoundError, but we keep the import if you want to fix it later.
 from quickbooks.client import QuickBooks 
 
+# --- Shared BigQuery client factory ---
+from clients import get_bq
+
 # --- Configuration File ---
 CONFIG_FILE = 'qbo_config.json'
 
 # Load credentials
 try:
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.load(f)
+    with open(CONFIG_FILE, 'rb') as f:
+        config = orjson.loads(f.read())
 except FileNotFoundError:
     print(f"❌ ERROR: Config file '{CONFIG_FILE}' not found. Please create it.")
     sys.exit(1)
 
+# --- Refresh Token Storage ---
+# When QB_REFRESH_TOKEN_SECRET_NAME is set, the rotating refresh token lives
+# in a versioned Secret Manager secret instead of this script rewriting the
+# whole config file on every run — no disk write on the startup path, and
+# concurrent runs can't clobber each other's token. Without the env var the
+# original file-based behaviour is kept (local/sandbox use).
+QB_TOKEN_SECRET_NAME = os.environ.get('QB_REFRESH_TOKEN_SECRET_NAME')
+QB_SECRETS_PROJECT = os.environ.get('QB_SECRETS_PROJECT_ID')
+_SECRET_CLIENT = None
+
+def _get_secret_client():
+    global _SECRET_CLIENT
+    if _SECRET_CLIENT is None:
+        _SECRET_CLIENT = secretmanager.SecretManagerServiceClient()
+    return _SECRET_CLIENT
+
+def read_refresh_token():
+    """Returns the current refresh token (Secret Manager if configured, else config file)."""
+    if QB_TOKEN_SECRET_NAME:
+        name = f"projects/{QB_SECRETS_PROJECT}/secrets/{QB_TOKEN_SECRET_NAME}/versions/latest"
+        response = _get_secret_client().access_secret_version(name=name)
+        return response.payload.data.decode("UTF-8")
+    return config['refresh_token']
+
+def save_refresh_token(new_token):
+    """Persists a rotated refresh token to wherever it was read from."""
+    if QB_TOKEN_SECRET_NAME:
+        parent = f"projects/{QB_SECRETS_PROJECT}/secrets/{QB_TOKEN_SECRET_NAME}"
+        _get_secret_client().add_secret_version(
+            parent=parent,
+            payload={"data": new_token.encode("UTF-8")}
+        )
+        print("✅ New Refresh Token saved to Secret Manager.")
+        return
+    config['refresh_token'] = new_token
+    with open(CONFIG_FILE, 'wb') as f:
+        f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+    print("✅ New Refresh Token successfully saved.")
+
 
 # ==============================================================================
 # 1. QBO AUTHENTICATION & TOKEN REFRESH (E)
@@ -41,18 +87,16 @@ auth_client = AuthClient(
 )
 
 try:
-    auth_client.refresh(refresh_token=config['refresh_token'])
+    current_refresh_token = read_refresh_token()
+    auth_client.refresh(refresh_token=current_refresh_token)
     
     # CRITICAL: Save the new Refresh Token
     new_refresh_token = auth_client.refresh_token
-    if new_refresh_token != config['refresh_token']:
-        config['refresh_token'] = new_refresh_token
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
-        print("✅ New Refresh Token successfully saved.")
+    if new_refresh_token != current_refresh_token:
+        save_refresh_token(new_refresh_token)
 
 except Exception as e:
-    print(f"❌ QBO Authentication Failed during refresh. Check token in {CONFIG_FILE}: {e}")
+    print(f"❌ QBO Authentication Failed during refresh. Check token storage: {e}")
     sys.exit(1)
 
 # Variables needed for the API call
@@ -62,35 +106,40 @@ env_base = "https://sandbox-quickbooks.api.intuit.com" if ENV == 'sandbox' else
 
 print("✅ QBO Client authenticated and tokens refreshed.")
 
+# One pooled keep-alive session for every page request: a single TLS
+# handshake amortized over the run, plus automatic backoff on QBO 429s/5xx.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+SESSION.headers.update({
+    'Authorization': f'Bearer {access_token}',
+    'Accept': 'application/json',
+    'Content-Type': 'application/x-www-form-urlencoded'
+})
+
 
 # ==============================================================================
 # 2. QBO DATA EXTRACTION (E) - Using Raw Requests
 # ==============================================================================
 
-def fetch_qbo_payments_raw(access_token, company_id, base_url):
-    """Fetches Payment data directly using the requests library and handles pagination."""
-    all_records = []
-    start_pos = 1
-    max_results = 1000
-    
-    print(f"\nStarting raw extraction for Payment...")
+def iter_qbo_payment_pages(access_token, company_id, base_url):
+    """Yields Payment pages, fetched concurrently after a COUNT(*) probe.
 
-    while True:
-        qbo_query = f"SELECT * FROM Payment STARTPOSITION {start_pos} MAXRESULTS {max_results}"
-        api_url = f"{base_url}/v3/company/{company_id}/query"
+    The probe tells us every page offset up front. Offsets are submitted in
+    waves of the pool size rather than all at once, so at most one wave of
+    fetched pages is ever buffered ahead of the (serial) consumer — without
+    the waves, every page would pile up in finished futures while the loader
+    drained them one by one.
+    """
+    max_results = 1000
+    api_url = f"{base_url}/v3/company/{company_id}/query"
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept': 'application/json',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+    def _run_query(qbo_query):
+        response = SESSION.get(api_url, params={'query': qbo_query})
 
-        response = requests.get(
-            api_url, 
-            headers=headers, 
-            params={'query': qbo_query}
-        )
-        
         if response.status_code == 401:
             print("❌ ERROR 401: Token expired. Restart script.")
             raise Exception("Unauthorized API Call.")
@@ -99,64 +148,70 @@ def fetch_qbo_payments_raw(access_token, company_id, base_url):
             print(f"❌ API Error {response.status_code}: {response.text}")
             raise Exception("QBO API Request Failed.")
 
-        data = response.json()
-        payments = data.get('QueryResponse', {}).get('Payment', [])
-        all_records.extend(payments)
-        
-        if len(payments) < max_results:
-            break
-        
-        start_pos += max_results
-        print(f"Fetched {len(all_records)} total records, continuing...")
-
-    print(f"✅ Extraction complete. Total {len(all_records)} records found.")
-    return pd.DataFrame(all_records) 
+        # orjson parses the 1000-record page bodies in native code — the
+        # hottest CPU step after the network wait itself.
+        return orjson.loads(response.content)
 
-# --- Execute the Extraction ---
-df_payments_raw = fetch_qbo_payments_raw(access_token, company_id, env_base)
-
-
-# ==============================================================================
-# 3. TRANSFORMATION (T)
-# ==============================================================================
-
-# 1. Flatten Customer ID
-df_payments_raw['customer_id'] = df_payments_raw['CustomerRef'].apply(
-    lambda x: x.get('value') if isinstance(x, dict) else None
-)
-
-# 2. Clean and convert data types
-df_payments_raw['transaction_date'] = pd.to_datetime(
-    df_payments_raw['TxnDate'], errors='coerce'
-).dt.date
-df_payments_raw['total_amount'] = pd.to_numeric(
-    df_payments_raw['TotalAmt'], errors='coerce'
-)
+    def _fetch_page(start_pos):
+        # Explicit column list: flatten_payment_page only reads these four
+        # fields, so there is no point shipping and parsing the rest.
+        data = _run_query(
+            f"SELECT Id, TxnDate, TotalAmt, CustomerRef FROM Payment STARTPOSITION {start_pos} MAXRESULTS {max_results}"
+        )
+        return data.get('QueryResponse', {}).get('Payment', [])
 
-# 3. Select final columns and rename for BigQuery standards
-df_payments_final = df_payments_raw[[
-    'Id',
-    'customer_id',
-    'transaction_date',
-    'total_amount',
-    # Include other desired columns (e.g., CurrencyRef, SyncToken)
-]].copy()
+    print(f"\nStarting raw extraction for Payment...")
 
-df_payments_final.rename(columns={'Id': 'payment_id'}, inplace=True)
-print("✅ Data transformation complete.")
+    count_data = _run_query("SELECT COUNT(*) FROM Payment")
+    total = count_data.get('QueryResponse', {}).get('totalCount', 0)
+    num_pages = max(1, math.ceil(total / max_results))
+    print(f"Found {total} Payment records across {num_pages} page(s).")
+
+    fetched = 0
+    pool_size = 8
+    start_positions = [1 + i * max_results for i in range(num_pages)]
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        for wave_start in range(0, len(start_positions), pool_size):
+            wave = start_positions[wave_start:wave_start + pool_size]
+            for payments in executor.map(_fetch_page, wave):
+                if payments:
+                    fetched += len(payments)
+                    yield payments
+
+    print(f"✅ Extraction complete. Total {fetched} records found.")
+
+
+def flatten_payment_page(page):
+    """Maps one raw Payment page onto the 4-column payments_header shape.
+
+    The output schema is tiny, so plain dicts beat a DataFrame here: no
+    object-dtype columns, no intermediate frame — peak memory is one fetch
+    wave of pages rather than the whole table.
+    TxnDate is already the 'YYYY-MM-DD' string BigQuery wants for a DATE.
+    """
+    return [
+        {
+            'payment_id': record.get('Id'),
+            'customer_id': (record.get('CustomerRef') or {}).get('value'),
+            'transaction_date': record.get('TxnDate'),
+            'total_amount': record.get('TotalAmt'),
+        }
+        for record in page
+    ]
 
 
 # ==============================================================================
-# 4. BIGQUERY LOADING (L)
+# 3. BIGQUERY LOADING (T & L)
 # ==============================================================================
 
 # --- BigQuery Credentials ---
-# NOTE: Ensure this file is uploaded and the path is correct
-BQ_KEY_PATH = 'we_are_hipaa_smart_google_key.json' 
+# The key path lives in clients.py alongside the shared factory.
 
 # Initialize the BQ client using your key file
 try:
-    bq_client = bigquery.Client.from_service_account_json(BQ_KEY_PATH) 
+    # Memoized factory: in a combined pipeline run all three scripts share a
+    # single authenticated client (and its HTTP pool).
+    bq_client = get_bq()
     print("✅ BigQuery Client authenticated.")
 except Exception as e:
     print(f"❌ BigQuery Authentication Failed. Check key path/content: {e}")
@@ -169,22 +224,42 @@ DATASET_ID = 'quickbooks_data'  # <-- UPDATE THIS DATASET NAME
 TABLE_ID = 'payments_header'
 table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
-# Configure the load job
-job_config = bigquery.LoadJobConfig(
-    write_disposition='WRITE_TRUNCATE', # Overwrites the table
-)
-
+# Known shape of the payments_header table. Passing it explicitly skips
+# BigQuery's dtype reflection and pins the column types deterministically.
+PAYMENTS_SCHEMA = [
+    bigquery.SchemaField('payment_id', 'STRING'),
+    bigquery.SchemaField('customer_id', 'STRING'),
+    bigquery.SchemaField('transaction_date', 'DATE'),
+    bigquery.SchemaField('total_amount', 'FLOAT64'),
+]
+
+# Stream the pages straight into BigQuery: each page is flattened to plain
+# dicts and loaded on its own, so the run holds at most one fetch wave of
+# pages in memory. The first job truncates (full refresh), the rest append.
+# Trade-off vs. the old single load job: a failure mid-run leaves the table
+# truncated and partially loaded instead of untouched — acceptable for this
+# sandbox script, where the next run re-truncates anyway.
 try:
-    # Execute the load job
-    job = bq_client.load_table_from_dataframe(
-        df_payments_final, 
-        table_ref, 
-        job_config=job_config
-    )
-
-    job.result() # Wait for the job to complete
+    total_loaded = 0
+    pages_loaded = 0
+    for page in iter_qbo_payment_pages(access_token, company_id, env_base):
+        job_config = bigquery.LoadJobConfig(
+            write_disposition='WRITE_TRUNCATE' if pages_loaded == 0 else 'WRITE_APPEND',
+            schema=PAYMENTS_SCHEMA,
+        )
+        job = bq_client.load_table_from_json(
+            flatten_payment_page(page),
+            table_ref,
+            job_config=job_config
+        )
+        job.result()  # Wait for the job to complete
+        total_loaded += job.output_rows
+        pages_loaded += 1
 
-    print(f"\n🚀 Success! Loaded {job.output_rows} rows into BigQuery table: {table_ref}")
+    if pages_loaded == 0:
+        print("⚠️ No Payment records returned; table left untouched.")
+    else:
+        print(f"\n🚀 Success! Loaded {total_loaded} rows into BigQuery table: {table_ref}")
 
 except Exception as e:
-    print(f"❌ BigQuery Load Failed: {e}")
\ No newline at end of file
+    print(f"❌ BigQuery Load Failed: {e}")
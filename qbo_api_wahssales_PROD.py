@@ -1,29 +1,59 @@
 # ==============================================================================
 # 0. IMPORTS AND INITIAL CONFIGURATION
 # ==============================================================================
-import json
+import datetime
+import io
+import math
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import re
 import requests
 import pandas as pd
-from google.cloud import bigquery 
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-import sys 
+import sys
 import numpy as np
 
+# Copy-on-Write: column selections share memory with their parent frame until
+# written to, so the transform below never needs a defensive .copy().
+pd.set_option('mode.copy_on_write', True)
+
+# One pooled session for all QBO calls: the TLS handshake is paid once and
+# reused across pages (and worker threads), with automatic backoff on 429/5xx.
+QBO_SESSION = requests.Session()
+QBO_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+
 # --- Required Intuit Libraries (for token management) ---
 from intuitlib.client import AuthClient 
 from quickbooks.client import QuickBooks 
 
+# --- Shared BigQuery client factory ---
+from clients import get_bq
+
 # --- Configuration File ---
 CONFIG_FILE = 'qbo_config_PROD.json'
 
 # Load credentials
 try:
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.load(f)
+    with open(CONFIG_FILE, 'rb') as f:
+        config = orjson.loads(f.read())
 except FileNotFoundError:
     print(f"❌ ERROR: Config file '{CONFIG_FILE}' not found. Please create it.")
     sys.exit(1)
 
+# High-water mark for incremental fetches. The checkpoint is taken at run
+# start (not run end) so records updated mid-run are re-fetched next time.
+LAST_SYNC = config.get('last_sync')
+RUN_STARTED_AT = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
 
 # ==============================================================================
 # 1. QBO AUTHENTICATION & TOKEN REFRESH (E)
@@ -45,8 +75,8 @@ try:
     new_refresh_token = auth_client.refresh_token
     if new_refresh_token != config['refresh_token']:
         config['refresh_token'] = new_refresh_token
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        with open(CONFIG_FILE, 'wb') as f:
+            f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
         print("✅ New Refresh Token successfully saved.")
 
 except Exception as e:
@@ -60,10 +90,15 @@ env_base = "https://quickbooks.api.intuit.com" # Production base URL
 TARGET_PRODUCT = 'Products:We Are, HIPAA Smart'
 TARGET_PRODUCT = TARGET_PRODUCT.strip() 
 
+_WS_RE = re.compile(r'\s+')
+
 def clean_and_lower(text):
-    """Robustly cleans input, ensuring it's a string, and converts to lowercase."""
-    s = str(text) if not pd.isna(text) and text is not None else ""
-    return ' '.join(s.split()).lower()
+    """Whitespace-folds and casefolds a value (empty string for None)."""
+    # Scalar pd.isna() is surprisingly expensive; callers only ever pass
+    # strings or None, so a plain None check suffices. casefold() is the
+    # aggressive Unicode fold — correct for comparisons where lower() can
+    # miss (and both sides of the compare go through this same function).
+    return "" if text is None else _WS_RE.sub(' ', str(text)).strip().casefold()
 
 TARGET_PRODUCT_CLEAN = clean_and_lower(TARGET_PRODUCT) 
 
@@ -74,31 +109,78 @@ print("✅ QBO Client authenticated and tokens refreshed.")
 # 2. QBO DATA EXTRACTION (E) & HELPER FUNCTIONS
 # ==============================================================================
 
-def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_name):
-    all_records = []
-    start_pos = 1
+def resolve_qbo_item_id(access_token, company_id, base_url, product_name):
+    """Looks up the QBO Item Id for the target product (None if lookup fails)."""
+    api_url = f"{base_url}/v3/company/{company_id}/query"
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+
+    # QBO Item names are the leaf of the fully-qualified 'Category:Name' path.
+    item_name = product_name.split(':')[-1].strip().replace("'", "\\'")
+
+    try:
+        response = QBO_SESSION.get(
+            api_url,
+            headers=headers,
+            params={'query': f"SELECT Id FROM Item WHERE Name = '{item_name}'"},
+            timeout=60
+        )
+        if response.status_code != 200:
+            print(f"⚠️ Item lookup failed ({response.status_code}); falling back to client-side filtering.")
+            return None
+
+        items = orjson.loads(response.content).get('QueryResponse', {}).get('Item', [])
+        if not items:
+            print(f"⚠️ No QBO Item named '{item_name}'; falling back to client-side filtering.")
+            return None
+
+        return items[0]['Id']
+
+    except Exception as e:
+        print(f"⚠️ Item lookup error: {e}; falling back to client-side filtering.")
+        return None
+
+def _build_where_clause(item_id=None, since=None):
+    """Assembles the server-side predicates (item filter and/or incremental cutoff)."""
+    predicates = []
+    if item_id:
+        # With a resolved item id, QBO only returns transactions containing the
+        # target product — most irrelevant rows never leave Intuit's servers.
+        predicates.append(f"Line.SalesItemLineDetail.ItemRef = '{item_id}'")
+    if since:
+        # >= (not >) so a record updated exactly at the checkpoint second is
+        # never skipped; the re-fetch is harmless now that deltas are merged.
+        predicates.append(f"MetaData.LastUpdatedTime >= '{since}'")
+    return f"WHERE {' AND '.join(predicates)} " if predicates else ""
+
+def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_name, item_id=None, since=None):
     max_results = 1000
-    
-    qbo_base_query = "SELECT * FROM SalesReceipt "
-    
-    print(f"\nStarting raw extraction for SALES RECEIPTS (Target: {product_name})...")
+    api_url = f"{base_url}/v3/company/{company_id}/query"
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
 
-    while True:
-        qbo_query = f"{qbo_base_query} STARTPOSITION {start_pos} MAXRESULTS {max_results}"
-        api_url = f"{base_url}/v3/company/{company_id}/query"
+    where_clause = _build_where_clause(item_id=item_id, since=since)
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept': 'application/json',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+    print(f"\nStarting raw extraction for SALES RECEIPTS (Target: {product_name})...")
 
-        response = requests.get(
-            api_url, 
-            headers=headers, 
-            params={'query': qbo_query}
+    def _run_query(qbo_query):
+        response = QBO_SESSION.get(
+            api_url,
+            headers=headers,
+            params={'query': qbo_query},
+            timeout=60
         )
-        
+
         if response.status_code != 200:
             print(f"\n🚨 API REQUEST FAILED DETAILS 🚨")
             print(f"Status Code: {response.status_code}")
@@ -106,135 +188,162 @@ def fetch_qbo_sales_receipts_raw(access_token, company_id, base_url, product_nam
             print("-----------------------------------")
             raise Exception("QBO API Request Failed during Sales Receipt fetch.")
 
-        data = response.json()
-        
-        receipts = data.get('QueryResponse', {}).get('SalesReceipt', [])
-        all_records.extend(receipts)
-        
-        if len(receipts) < max_results:
-            break
-        
-        start_pos += max_results
-        print(f"Fetched {len(all_records)} total records, continuing...")
-
-    df_raw = pd.DataFrame(all_records)
-    
-    if not df_raw.empty:
+        # orjson parses the (potentially multi-MB) page body in C.
+        return orjson.loads(response.content)
+
+    def _fetch_page(start_pos):
+        # Explicit column list: only the fields the transform reads, instead
+        # of the dozens SELECT * ships per record.
+        qbo_query = f"SELECT Id, TxnDate, TotalAmt, Balance, CustomerRef, Line FROM SalesReceipt {where_clause}STARTPOSITION {start_pos} MAXRESULTS {max_results}"
+        data = _run_query(qbo_query)
+        return data.get('QueryResponse', {}).get('SalesReceipt', [])
+
+    # One cheap COUNT query tells us how many pages exist, so every page can be
+    # requested concurrently instead of paying one round-trip per page.
+    try:
+        count_data = _run_query(f"SELECT COUNT(*) FROM SalesReceipt {where_clause}")
+    except Exception:
+        if not item_id:
+            raise
+        # Realm rejected the line-item predicate — retry with only the cutoff.
+        print("⚠️ Server-side item filter rejected; retrying unfiltered.")
+        where_clause = _build_where_clause(since=since)
+        count_data = _run_query(f"SELECT COUNT(*) FROM SalesReceipt {where_clause}")
+    total_count = count_data.get('QueryResponse', {}).get('totalCount', 0)
+    num_pages = max(1, math.ceil(total_count / max_results))
+    print(f"Found {total_count} Sales Receipts across {num_pages} page(s).")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pages = executor.map(_fetch_page, [1 + i * max_results for i in range(num_pages)])
+        # One Arrow table per page, one concat at the end — pandas never has to
+        # walk the full list of nested dicts to infer columns.
+        page_tables = [pa.Table.from_pylist(page) for page in pages if page]
+
+    if page_tables:
+        df_raw = pa.concat_tables(page_tables, promote_options='permissive').to_pandas()
         df_raw['transaction_type'] = 'Sales Receipt'
-        
-    print(f"✅ Extraction complete. Total {len(all_records)} Sales Receipt records found.")
+    else:
+        df_raw = pd.DataFrame()
+
+    print(f"✅ Extraction complete. Total {len(df_raw)} Sales Receipt records found.")
     return df_raw
 
-def fetch_qbo_invoices_raw(access_token, company_id, base_url, product_name):
-    """Fetches INVOICES (unfiltered) up to 1000 records for filtering."""
-    all_records = []
-    start_pos = 1
+def fetch_qbo_invoices_raw(access_token, company_id, base_url, product_name, item_id=None, since=None):
+    """Fetches INVOICES (server-filtered when possible), paged like the receipts."""
     max_results = 1000
-    
-    qbo_base_query = "SELECT * FROM Invoice " 
-    
-    print(f"\nStarting raw extraction for INVOICES (FULL FETCH for filtering)...")
+    api_url = f"{base_url}/v3/company/{company_id}/query"
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
 
-    while start_pos <= 1000: # Limit fetch to 1000 records total
-        
-        qbo_query = f"{qbo_base_query} STARTPOSITION {start_pos} MAXRESULTS {max_results}"
-        api_url = f"{base_url}/v3/company/{company_id}/query" 
+    where_clause = _build_where_clause(item_id=item_id, since=since)
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept': 'application/json',
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+    print(f"\nStarting raw extraction for INVOICES (Target: {product_name})...")
+
+    def _run_query(qbo_query):
+        response = QBO_SESSION.get(api_url, headers=headers, params={'query': qbo_query}, timeout=60)
 
-        response = requests.get(api_url, headers=headers, params={'query': qbo_query})
-        
         if response.status_code != 200:
             print(f"❌ API Error {response.status_code}: {response.text}")
             raise Exception("QBO API Request Failed during Invoice fetch.")
 
-        data = response.json()
-        invoices = data.get('QueryResponse', {}).get('Invoice', [])
-        all_records.extend(invoices)
-        
-        if len(invoices) < max_results:
-            break
-        
-        start_pos += max_results
-        print(f"Fetched {len(all_records)} total invoice records, continuing...")
-
-    df_raw = pd.DataFrame(all_records)
-    
-    if not df_raw.empty:
-        df_raw['transaction_type'] = 'Invoice' 
-
-    print(f"✅ Extraction complete. Total {len(all_records)} Invoice records retrieved for filtering.")
+        return orjson.loads(response.content)
+
+    def _fetch_page(start_pos):
+        qbo_query = f"SELECT Id, TxnDate, TotalAmt, Balance, CustomerRef, Line FROM Invoice {where_clause}STARTPOSITION {start_pos} MAXRESULTS {max_results}"
+        data = _run_query(qbo_query)
+        return data.get('QueryResponse', {}).get('Invoice', [])
+
+    # Same COUNT-probe-then-parallel-pages pattern as the receipts. This also
+    # retires the old hard 1000-record ceiling — with the server-side item
+    # filter in place a full fetch is cheap, and without it the old cap was
+    # silently dropping data past the first page.
+    try:
+        count_data = _run_query(f"SELECT COUNT(*) FROM Invoice {where_clause}")
+    except Exception:
+        if not item_id:
+            raise
+        # Realm rejected the line-item predicate — retry with only the cutoff.
+        print("⚠️ Server-side item filter rejected; retrying unfiltered.")
+        where_clause = _build_where_clause(since=since)
+        count_data = _run_query(f"SELECT COUNT(*) FROM Invoice {where_clause}")
+    total_count = count_data.get('QueryResponse', {}).get('totalCount', 0)
+    num_pages = max(1, math.ceil(total_count / max_results))
+    print(f"Found {total_count} Invoices across {num_pages} page(s).")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pages = executor.map(_fetch_page, [1 + i * max_results for i in range(num_pages)])
+        page_tables = [pa.Table.from_pylist(page) for page in pages if page]
+
+    if page_tables:
+        df_raw = pa.concat_tables(page_tables, promote_options='permissive').to_pandas()
+        df_raw['transaction_type'] = 'Invoice'
+    else:
+        df_raw = pd.DataFrame()
+
+    print(f"✅ Extraction complete. Total {len(df_raw)} Invoice records retrieved for filtering.")
     return df_raw
 
-def get_item_name(line):
-    """Safely extracts and strips whitespace from the item name."""
-    if isinstance(line, dict) and line.get('SalesItemLineDetail'):
-        name = line['SalesItemLineDetail'].get('ItemRef', {}).get('name')
-        if name:
-            return str(name).strip() 
-    return None
-
-def get_line_detail(line, key):
-    """Safely extracts a specific value (Qty, Rate) from SalesItemLineDetail."""
-    if isinstance(line, dict) and line.get('SalesItemLineDetail'):
-        return line['SalesItemLineDetail'].get(key)
-    return None
+FINAL_COLS = ['Id', 'customer_name', 'transaction_date', 'item_name_raw',
+              'transaction_type', 'TotalAmt', 'Balance', 'quantity', 'sales_price']
 
 def process_and_filter_df(df_raw, target_product_clean):
     """Processes, flattens, and filters a single DataFrame."""
-    
+
     #1: If input is empty, return an empty DataFrame with the full schema
     if df_raw.empty:
-        return pd.DataFrame(columns=['Id', 'customer_name', 'transaction_date', 'item_name_raw', 'transaction_type', 'TotalAmt']) 
-
-    # 1. Flatten Header Data
-    df_raw['customer_name'] = df_raw['CustomerRef'].apply(
-        lambda x: x.get('name') if isinstance(x, dict) else None
-    )
-    df_raw['transaction_date'] = pd.to_datetime(
-        df_raw['TxnDate'], errors='coerce'
-    ).dt.date
-
-    # 2. Explode the line items
-    df_lines = df_raw.explode('Line', ignore_index=True) 
-
-    # 3. Extract Item Name and Apply Filter (Creation of item_name_raw and item_name_lower)
-    df_lines['item_name_raw'] = df_lines['Line'].apply(get_item_name) 
-    df_lines['item_name_lower'] = df_lines['item_name_raw'].apply(clean_and_lower)
-    df_lines['quantity'] = df_lines['Line'].apply(lambda x: get_line_detail(x, 'Qty'))
-    df_lines['sales_price'] = df_lines['Line'].apply(lambda x: get_line_detail(x, 'UnitPrice'))
+        return pd.DataFrame(columns=FINAL_COLS)
+
+    # One fused pass over the records: explode plus the json_normalize passes
+    # re-walked every exploded line several times and materialized columns for
+    # rows that were about to be filtered away. This walks each line item
+    # exactly once and keeps only matching rows.
+    needed = df_raw.reindex(columns=['Id', 'CustomerRef', 'TxnDate', 'Line',
+                                     'TotalAmt', 'Balance', 'transaction_type'])
+    rows = []
+    # A company carries a few dozen distinct item names at most, so the
+    # regex fold + compare runs once per unique name; every repeat is a
+    # dict hit instead of another clean_and_lower call.
+    match_cache = {}
+    for r in needed.itertuples(index=False):
+        # Arrow hands list columns back as numpy arrays; missing ones are NaN.
+        lines = r.Line if isinstance(r.Line, (list, tuple, np.ndarray)) else ()
+        for line in lines:
+            det = line.get('SalesItemLineDetail') or {}
+            if not det:
+                continue
+            item = ((det.get('ItemRef') or {}).get('name') or '').strip()
+            matched = match_cache.get(item)
+            if matched is None:
+                matched = match_cache[item] = (clean_and_lower(item) == target_product_clean)
+            if not matched:
+                continue
+            # Header fields are only dug out once a line has passed the
+            # filter — the typical record contributes no rows at all.
+            customer_name = r.CustomerRef.get('name') if isinstance(r.CustomerRef, dict) else None
+            rows.append((r.Id, customer_name, r.TxnDate, item, r.transaction_type,
+                         r.TotalAmt, r.Balance, det.get('Qty'), det.get('UnitPrice')))
 
-
-    # ------------------------------------------------------------------
-    # --- TEMPORARY FIX: BYPASS FILTER TO DUMP ALL DATA ---
-    #df_product_lines = df_lines.copy() # <--- Use ALL lines for the dump
-    # -----------------------------------------------------
-    
-    # Filter the data frame 
-    df_product_lines = df_lines[df_lines['item_name_lower'] == target_product_clean].copy()
-    
     # Check 2: If the filtered result is empty, return an empty DataFrame with final schema
-    if df_product_lines.empty:
-        return pd.DataFrame(columns=['Id', 'customer_name', 'transaction_date', 'item_name_raw', 'transaction_type', 'TotalAmt'])
-    
-    # 4. RFinal selection of needed columns for the combined frame
-    df_final_cols = df_product_lines[[
-        'Id', 
-        'customer_name',
-        'transaction_date',
-        'item_name_raw', 
-        'transaction_type', 
-        'TotalAmt',
-        'Balance',           # <--- ADDED BALANCE (Header Field)
-        'quantity',          # <--- ADDED QUANTITY (Line Detail)
-        'sales_price'        # <--- ADDED SALES PRICE (Line Detail)
-    ]].copy()
+    if not rows:
+        return pd.DataFrame(columns=FINAL_COLS)
+
+    df_final_cols = pd.DataFrame.from_records(rows, columns=[
+        'Id', 'customer_name', 'TxnDate', 'item_name_raw', 'transaction_type',
+        'TotalAmt', 'Balance', 'quantity', 'sales_price'
+    ])
+
+    # Parse dates only for the surviving rows — to_datetime over the full raw
+    # frame was the priciest step, and most rows get filtered.
+    df_final_cols['transaction_date'] = pd.to_datetime(
+        df_final_cols['TxnDate'], errors='coerce'
+    ).dt.date
 
-    return df_final_cols
+    return df_final_cols[FINAL_COLS]
 
 
 #  ==============================================================================
@@ -242,8 +351,20 @@ def process_and_filter_df(df_raw, target_product_clean):
 # ==============================================================================
 
 # --- EXECUTION: Runs both extraction functions ---
-df_receipts_raw = fetch_qbo_sales_receipts_raw(access_token, company_id, env_base, TARGET_PRODUCT) 
-df_invoices_raw = fetch_qbo_invoices_raw(access_token, company_id, env_base, TARGET_PRODUCT)
+# Resolve the target product's Item Id so full refreshes can filter
+# server-side; the client-side filter below stays on as a correctness guard.
+# Incremental runs deliberately skip the item filter: the delta must include
+# every transaction QBO touched since the checkpoint — including ones edited
+# to no longer contain the product — so their stale rows get deleted in the
+# merge. The delta is small, so fetching it unfiltered is cheap.
+if LAST_SYNC:
+    TARGET_ITEM_ID = None
+    print(f"Incremental run: fetching records updated since {LAST_SYNC}.")
+else:
+    TARGET_ITEM_ID = resolve_qbo_item_id(access_token, company_id, env_base, TARGET_PRODUCT)
+
+df_receipts_raw = fetch_qbo_sales_receipts_raw(access_token, company_id, env_base, TARGET_PRODUCT, item_id=TARGET_ITEM_ID, since=LAST_SYNC)
+df_invoices_raw = fetch_qbo_invoices_raw(access_token, company_id, env_base, TARGET_PRODUCT, item_id=TARGET_ITEM_ID, since=LAST_SYNC)
 
 
 # --- Process Each DataFrame Separately and Filter ---
@@ -262,13 +383,21 @@ dfs_to_concat = [df_filtered_receipts, df_filtered_invoices]
 dfs_to_concat = [df for df in dfs_to_concat if not df.empty]
 
 
+# Column set of the serving table — the non-empty path below must produce
+# exactly this layout, and the empty fallback mirrors it.
+SERVING_COLS = ['transaction_id', 'customer_name', 'transaction_date', 'product_name',
+                'transaction_type', 'quantity', 'sales_price', 'total_amount']
+
 if not dfs_to_concat:
     print(f"⚠️ WARNING: No transactions found matching '{TARGET_PRODUCT}'. Loading 0 rows to BQ.")
-    df_payments_final = pd.DataFrame(columns=['transaction_id', 'customer_name', 'transaction_date', 'product_name', 'line_amount', 'transaction_type'])
+    df_payments_final = pd.DataFrame(columns=SERVING_COLS)
 
 else:
-    # Concatenate the standardized DataFrames
-    df_combined_filtered = pd.concat(dfs_to_concat, ignore_index=True)
+    # Concatenate the standardized DataFrames. Both frames come out of
+    # process_and_filter_df with the identical FINAL_COLS layout, so concat
+    # skips column alignment; copy=False lets CoW share the blocks instead of
+    # duplicating both frames into the combined one.
+    df_combined_filtered = pd.concat(dfs_to_concat, ignore_index=True, copy=False)
 
     # --- Final Selection and Rename ---
     amount_key = 'TotalAmt' 
@@ -289,16 +418,17 @@ else:
         'item_name_raw': 'product_name'
     })
     
-    # Final Cleaning (Ensure numeric conversion)
-    df_payments_final['total_amount'] = pd.to_numeric(
-        df_payments_final['total_amount'], errors='coerce'
-    )
-    df_payments_final['quantity'] = pd.to_numeric(
-        df_payments_final['quantity'], errors='coerce'
-    )
-    df_payments_final['sales_price'] = pd.to_numeric(
-        df_payments_final['sales_price'], errors='coerce'
-    )
+    # Final Cleaning (Ensure numeric conversion). downcast='float' lands the
+    # money columns in float32 — half the bytes in RAM and in the Parquet
+    # payload, and well within precision for currency-sized values.
+    for numeric_col in ('total_amount', 'quantity', 'sales_price'):
+        df_payments_final[numeric_col] = pd.to_numeric(
+            df_payments_final[numeric_col], errors='coerce', downcast='float'
+        )
+
+    # transaction_type only ever holds 'Sales Receipt' / 'Invoice'; category
+    # stores the codes once and one small int per row.
+    df_payments_final['transaction_type'] = df_payments_final['transaction_type'].astype('category')
 
 print("✅ Data transformation complete.")
 
@@ -308,10 +438,12 @@ print("✅ Data transformation complete.")
 # ==============================================================================
 
 # --- BigQuery Credentials ---
-BQ_KEY_PATH = 'we_are_hipaa_smart_google_key.json' 
+# The key path lives in clients.py alongside the shared factory.
 
 try:
-    bq_client = bigquery.Client.from_service_account_json(BQ_KEY_PATH) 
+    # Memoized factory: in a combined pipeline run all three scripts share a
+    # single authenticated client (and its HTTP pool).
+    bq_client = get_bq()
     print("✅ BigQuery Client authenticated.")
 except Exception as e:
     print(f"❌ BigQuery Authentication Failed. Check key path/content: {e}")
@@ -324,24 +456,134 @@ DATASET_ID = 'quickbooks_data'
 TABLE_ID = 'wahs_qbo_sales' 
 table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
-# Configure the load job
-job_config = bigquery.LoadJobConfig(
-    write_disposition='WRITE_TRUNCATE', 
-)
-
-try:
-    df_to_load = df_payments_final 
+# Load in bounded chunks. A full (checkpoint-less) run truncates on its first
+# chunk and appends the rest, so each POST body stays bounded instead of one
+# monolithic job at full frame size. Incremental runs land the delta in a
+# staging table first, then one query deletes every transaction QBO touched
+# since the checkpoint from the serving table and inserts the staged rows —
+# re-edits replace their old rows instead of double-counting, and a voided
+# transaction (touched, but no longer matching the product filter) simply
+# gets deleted.
+#
+# Considered and rejected: the Storage Write API (pending streams). It shaves
+# the per-job latency, but its default/pending streams are append-only — the
+# truncate-on-first-run semantics here would need a separate DDL step — and it
+# drags in proto schema generation plus the bigquery-storage dependency. At
+# this table's volumes (thousands of rows) the load-job overhead is a few
+# seconds a day; not worth the machinery.
+LOAD_CHUNK_ROWS = 50_000
+staging_ref = f"{table_ref}_staging"
+load_target = staging_ref if LAST_SYNC else table_ref
+
+# Pinned load schema (mirrors SERVING_COLS). Without it an empty frame
+# serializes to all-null-typed Parquet columns that can't land against the
+# table's real types; with it, every load — staging included — carries the
+# serving shape.
+SALES_SCHEMA = [
+    bigquery.SchemaField('transaction_id', 'STRING'),
+    bigquery.SchemaField('customer_name', 'STRING'),
+    bigquery.SchemaField('transaction_date', 'DATE'),
+    bigquery.SchemaField('product_name', 'STRING'),
+    bigquery.SchemaField('transaction_type', 'STRING'),
+    bigquery.SchemaField('quantity', 'FLOAT64'),
+    bigquery.SchemaField('sales_price', 'FLOAT64'),
+    bigquery.SchemaField('total_amount', 'FLOAT64'),
+]
+
+
+def _raw_ids(df):
+    """All transaction Ids in a raw delta frame (pre product filter)."""
+    return df['Id'].dropna().astype(str).tolist() if 'Id' in df.columns else []
+
+
+def _delete_touched(ids):
+    """Removes every serving-table row for the given transaction ids."""
+    bq_client.query(
+        f"DELETE FROM `{table_ref}` WHERE transaction_id IN UNNEST(@delta_ids)",
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter('delta_ids', 'STRING', ids)]
+        ),
+    ).result()
 
-    # Execute the load job
-    job = bq_client.load_table_from_dataframe(
-        df_to_load, 
-        table_ref, 
-        job_config=job_config
-    )
 
-    job.result() 
-
-    print(f"\n🚀 Success! Loaded {job.output_rows} rows into BigQuery table: {table_ref}")
+try:
+    delta_ids = []
+    if LAST_SYNC:
+        delta_ids = sorted(set(_raw_ids(df_receipts_raw)) | set(_raw_ids(df_invoices_raw)))
+
+    if LAST_SYNC and not delta_ids:
+        # Quiet day: QBO touched nothing since the checkpoint. Skip the load
+        # and merge entirely — but still advance the checkpoint below.
+        print("✅ No QBO changes since the checkpoint; nothing to load.")
+
+    elif df_payments_final.empty:
+        if LAST_SYNC:
+            # Transactions were touched, but none still matches the product —
+            # their stale rows just need deleting; nothing to stage.
+            _delete_touched(delta_ids)
+            print(f"\n🚀 Success! Removed {len(delta_ids)} touched transaction(s); no matching rows to load.")
+        else:
+            # Full refresh with no matches: keep the truncate semantics
+            # without round-tripping an empty Parquet file.
+            bq_client.query(f"TRUNCATE TABLE `{table_ref}`").result()
+            print(f"\n🚀 Success! Loaded 0 rows into BigQuery table: {table_ref} (table truncated).")
+
+    else:
+        total_loaded = 0
+        for i, start in enumerate(range(0, len(df_payments_final), LOAD_CHUNK_ROWS)):
+            chunk = df_payments_final.iloc[start:start + LOAD_CHUNK_ROWS]
+
+            job_config = bigquery.LoadJobConfig(
+                write_disposition='WRITE_TRUNCATE' if i == 0 else 'WRITE_APPEND',
+                source_format=bigquery.SourceFormat.PARQUET,
+                schema=SALES_SCHEMA,
+            )
+
+            # Serialize to Parquet ourselves instead of letting load_table_from_dataframe
+            # pick defaults: zstd compresses tighter than snappy, and dictionary
+            # encoding collapses the heavily repeated product/customer strings.
+            arrow_table = pa.Table.from_pandas(chunk, preserve_index=False)
+            buf = io.BytesIO()
+            pq.write_table(arrow_table, buf, compression='zstd', use_dictionary=True)
+            buf.seek(0)
+
+            job = bq_client.load_table_from_file(buf, load_target, job_config=job_config)
+            job.result()
+            total_loaded += job.output_rows
+
+        if LAST_SYNC:
+            # Replace, don't append: drop every row for a transaction QBO
+            # touched since the checkpoint (the delta was fetched without the
+            # item filter, so edits that no longer match are covered), then
+            # insert the staged rows. Wrapped in an explicit transaction —
+            # multi-statement scripts otherwise commit per statement, and a
+            # failed INSERT must not leave the DELETE committed on its own.
+            # Delete+insert rather than MERGE because transaction_id repeats
+            # per line item.
+            dedupe_sql = (
+                "BEGIN TRANSACTION;\n"
+                f"DELETE FROM `{table_ref}` WHERE transaction_id IN UNNEST(@delta_ids);\n"
+                f"INSERT INTO `{table_ref}` SELECT * FROM `{staging_ref}`;\n"
+                "COMMIT TRANSACTION;"
+            )
+            bq_client.query(
+                dedupe_sql,
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ArrayQueryParameter('delta_ids', 'STRING', delta_ids)
+                    ]
+                ),
+            ).result()
+            bq_client.delete_table(staging_ref, not_found_ok=True)
+            print(f"\n🚀 Success! Merged {total_loaded} delta rows into BigQuery table: {table_ref}")
+        else:
+            print(f"\n🚀 Success! Loaded {total_loaded} rows into BigQuery table: {table_ref}")
+
+    # Persist the high-water mark only after the load lands.
+    config['last_sync'] = RUN_STARTED_AT
+    with open(CONFIG_FILE, 'wb') as f:
+        f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+    print(f"✅ Sync checkpoint saved ({RUN_STARTED_AT}).")
 
 except Exception as e:
-    print(f"❌ BigQuery Load Failed: {e}")
\ No newline at end of file
+    print(f"❌ BigQuery Load Failed: {e}")
@@ -5,7 +5,7 @@ from datetime import datetime
 
 # 1. Configuration
 # We read the password from the environment variable we will set up in the deploy step
-WP_PASSWORD = os.environ.get('WP_PASSWORD') 
+WP_PASSWORD = os.environ.get('WP_PASSWORD')
 WP_USER = "cassie.haxton@hedyandhopp.com"
 WP_URL = "https://wearehipaasmart.com/"
 
@@ -13,17 +13,25 @@ WP_URL = "https://wearehipaasmart.com/"
 PROJECT_ID = "325576423919"
 DATASET_ID = "learndash_stats"
 TABLE_ID = "daily_student_count"
+TABLE_REF = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+
+# Built once at import: warm Cloud Function instances reuse the authenticated
+# BigQuery client and the keep-alive WordPress session across invocations
+# instead of redoing the OAuth/TLS handshakes every run.
+BQ_CLIENT = bigquery.Client(project=PROJECT_ID)
+WP_SESSION = requests.Session()
+WP_SESSION.auth = (WP_USER, WP_PASSWORD)
 
 def sync_learndash_data():
     if not WP_PASSWORD:
         raise ValueError("WP_PASSWORD not found. Check Secret Manager mounting.")
 
     print("Fetching data from WordPress...")
-    
+
     # 2. Get Data
     params = {'roles': 'subscriber', 'per_page': 1}
-    response = requests.get(WP_URL, auth=(WP_USER, WP_PASSWORD), params=params)
-    
+    response = WP_SESSION.get(WP_URL, params=params)
+
     if response.status_code != 200:
         raise Exception(f"WP Error: {response.text}")
 
@@ -32,20 +40,17 @@ def sync_learndash_data():
     print(f"Found {total_students} students.")
 
     # 3. Push to BigQuery
-    client = bigquery.Client(project=PROJECT_ID)
-    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
-    
     rows = [{
         "date": datetime.now().date().isoformat(),
         "total_students": total_students
     }]
-    
-    errors = client.insert_rows_json(table_ref, rows)
-    
+
+    errors = BQ_CLIENT.insert_rows_json(TABLE_REF, rows)
+
     if errors == []:
         print("Success! BigQuery updated.")
     else:
         print(f"BigQuery Errors: {errors}")
 
 if __name__ == "__main__":
-    sync_learndash_data()
\ No newline at end of file
+    sync_learndash_data()
@@ -1,8 +1,15 @@
 # ==============================================================================
 # 0. IMPORTS AND GLOBAL DEFINITIONS
 # ==============================================================================
-import json
-import requests
+import asyncio
+import functools
+import io
+import itertools
+import math
+import re
+import time
+import aiohttp
+import orjson
 import pandas as pd
 from google.cloud import bigquery 
 from google.cloud import secretmanager 
@@ -20,15 +27,54 @@ BQ_KEY_FILE = '/secrets/bq-key/key.json'
 # NEW (The correct string from your BQ diagnostic)
 TARGET_PRODUCT = 'Products:We Are, HIPAA Smart'
 
+# Known shape of the wahs_qbo_sales table. A fixed schema means BigQuery
+# takes the Parquet columns as-is instead of re-inferring types per load.
+WAHS_SALES_SCHEMA = [
+    bigquery.SchemaField('transaction_id', 'STRING'),
+    bigquery.SchemaField('customer_name', 'STRING'),
+    bigquery.SchemaField('transaction_date', 'DATE'),
+    bigquery.SchemaField('product_name', 'STRING'),
+    bigquery.SchemaField('transaction_type', 'STRING'),
+    bigquery.SchemaField('total_amount', 'FLOAT64'),
+]
+
+# QBO access tokens live ~1 hour; warm Cloud Function instances keep module
+# state alive, so caching the token here saves a Secret Manager read plus an
+# Intuit OAuth round-trip on every request while it is still valid.
+_TOKEN_CACHE = {'access_token': None, 'expires_at': 0.0, 'refresh_token': None}
+
+# Same idea for the BigQuery client: build it once per process.
+_BQ_CLIENT = None
+
+def _get_bq_client():
+    global _BQ_CLIENT
+    if _BQ_CLIENT is None:
+        _BQ_CLIENT = bigquery.Client()
+    return _BQ_CLIENT
+
 # --- Final Global Helpers (Used inside run_pipeline) ---
+_WS_RE = re.compile(r'\s+')
+
 def clean_and_lower(text):
-    """Robustly cleans input, ensuring it's a string, and converts to lowercase."""
-    s = str(text) if not pd.isna(text) and text is not None else ""
-    return ' '.join(s.split()).lower()
+    """Whitespace-folds and lowercases a value (empty string for None)."""
+    # Scalar pd.isna() is surprisingly expensive; callers only ever pass
+    # strings or None, so a plain None check suffices.
+    if text is None:
+        return ""
+    return _WS_RE.sub(' ', str(text)).strip().lower()
 
 # The clean target product is derived once
 TARGET_PRODUCT_CLEAN = clean_and_lower(TARGET_PRODUCT) 
 
+# A company typically has well under a hundred distinct item names, but the
+# flatten loop sees one per line item. Memoizing the *comparison* (not just
+# the normalized string) means every repeat costs one dict hit that yields
+# the bool directly, and the cache survives warm invocations.
+@functools.lru_cache(maxsize=512)
+def _is_target_product(name):
+    """True if a raw item name matches TARGET_PRODUCT after case/space folding."""
+    return clean_and_lower(name) == TARGET_PRODUCT_CLEAN
+
 # ==============================================================================
 # GOOGLE CLOUD SECRET MANAGER HELPER FUNCTIONS
 # ==============================================================================
@@ -75,6 +121,10 @@ def run_pipeline(request=None):
         QB_SECRET_NAME = os.environ['QB_SECRET_NAME'] # Name of the secret holding the Refresh Token
         COMPANY_ID = os.environ['QB_COMPANY_ID']     # Realm ID
         BQ_PROJECT_ID = os.environ['BQ_PROJECT_ID']
+
+        # Optional: secret holding the last successful sync timestamp.
+        # Unset -> every run is a full refresh, exactly as before.
+        QB_SYNC_STATE_SECRET = os.environ.get('QB_SYNC_STATE_SECRET_NAME')
         
     except KeyError as e:
         print(f"❌ ERROR: Missing required environment variable: {e}")
@@ -90,32 +140,46 @@ def run_pipeline(request=None):
     # 2. QBO AUTHENTICATION & TOKEN REFRESH (E)
     # ==============================================================================
 
-    # Retrieve current token from Secret Manager
-    try:
-        QB_REFRESH_TOKEN_INITIAL = get_latest_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SECRET_NAME)
-    except Exception as e:
-        print(f"❌ ERROR: Could not retrieve initial token: {e}")
-        return "QBO Authentication Failed: Token retrieval error.", 500
-
-    auth_client = AuthClient(
-        QB_CLIENT_ID,
-        QB_CLIENT_SECRET,
-        QB_REDIRECT_URI,
-        ENV 
-    )
+    if time.time() < _TOKEN_CACHE['expires_at'] - 60:
+        # Warm instance with a still-valid access token: skip both the
+        # Secret Manager read and the Intuit OAuth round-trip.
+        access_token = _TOKEN_CACHE['access_token']
+        print("♻️ Reusing cached QBO access token (warm instance).")
+    else:
+        # Retrieve current token from Secret Manager (or the in-process copy
+        # saved by a previous refresh on this instance)
+        try:
+            QB_REFRESH_TOKEN_INITIAL = (
+                _TOKEN_CACHE['refresh_token']
+                or get_latest_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SECRET_NAME)
+            )
+        except Exception as e:
+            print(f"❌ ERROR: Could not retrieve initial token: {e}")
+            return "QBO Authentication Failed: Token retrieval error.", 500
+
+        auth_client = AuthClient(
+            QB_CLIENT_ID,
+            QB_CLIENT_SECRET,
+            QB_REDIRECT_URI,
+            ENV
+        )
 
-    try:
-        auth_client.refresh(refresh_token=QB_REFRESH_TOKEN_INITIAL)
-        new_refresh_token = auth_client.refresh_token
-        
-        if new_refresh_token != QB_REFRESH_TOKEN_INITIAL:
-            update_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SECRET_NAME, new_refresh_token)
+        try:
+            auth_client.refresh(refresh_token=QB_REFRESH_TOKEN_INITIAL)
+            new_refresh_token = auth_client.refresh_token
 
-    except Exception as e:
-        print(f"❌ QBO Authentication Failed during refresh: {e}")
-        return f"QBO Authentication Failed: {e}", 500
+            if new_refresh_token != QB_REFRESH_TOKEN_INITIAL:
+                update_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SECRET_NAME, new_refresh_token)
+
+        except Exception as e:
+            print(f"❌ QBO Authentication Failed during refresh: {e}")
+            return f"QBO Authentication Failed: {e}", 500
 
-    access_token = auth_client.access_token
+        access_token = auth_client.access_token
+        _TOKEN_CACHE['access_token'] = access_token
+        _TOKEN_CACHE['refresh_token'] = new_refresh_token
+        # expires_in is ~3600s for QBO; fall back to that if the lib omits it.
+        _TOKEN_CACHE['expires_at'] = time.time() + (getattr(auth_client, 'expires_in', None) or 3600)
     print("--- Authentication Success. Starting Pipeline Execution ---")
     #raise Exception("CLOUDMONITORING_ALERT_TEST_FAILURE: Intentionally crashing the pipeline to test alert.")
     
@@ -125,167 +189,217 @@ def run_pipeline(request=None):
     # ==============================================================================
     # 3. QBO DATA EXTRACTION (E) & TRANSFORMATION (T)
     # ==============================================================================
+
+    # Incremental high-water mark: fetch only transactions QBO touched since
+    # the last successful run. Captured before fetching so edits that land
+    # mid-run are picked up next time.
+    last_sync = None
+    if QB_SYNC_STATE_SECRET:
+        try:
+            last_sync = get_latest_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SYNC_STATE_SECRET)
+        except Exception as e:
+            print(f"⚠️ No previous sync timestamp ({e}); doing a full fetch.")
+    run_started_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
     
     # --- Function Definitions (Moved inside for cleaner global namespace) ---
-    def fetch_qbo_sales_receipts_raw(access_token, COMPANY_ID, base_url, product_name):
-        all_records = []
-        start_pos = 1
-        max_results = 1000
-        qbo_base_query = "SELECT * FROM SalesReceipt "
-        
-        print(f"\nStarting raw extraction for SALES RECEIPTS (Target: {product_name})...")
-
-        while True: 
-            qbo_query = f"{qbo_base_query} STARTPOSITION {start_pos} MAXRESULTS {max_results}"
-            api_url = f"{base_url}/v3/company/{COMPANY_ID}/query"
-
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Accept': 'application/json',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-
-            response = requests.get(api_url, headers=headers, params={'query': qbo_query})
-            
-            if response.status_code != 200:
-                print(f"\n🚨 API REQUEST FAILED DETAILS 🚨")
-                print(f"Status Code: {response.status_code}")
-                print(f"Response Body: {response.text}")
-                print("-----------------------------------")
-                raise Exception("QBO API Request Failed during Sales Receipt fetch.")
-
-            data = response.json()
-            receipts = data.get('QueryResponse', {}).get('SalesReceipt', [])
-
-            if not receipts:
-                print("No more sales receipts found. Ending fetch.")
-                break 
-
-            all_records.extend(receipts)
-            
-            if len(receipts) < max_results: 
-                print(f"Last page reached. Total {len(all_records)} sales receipts.")
-                break
-            
-            start_pos += max_results
-            print(f"Fetched {len(all_records)} total sales receipt records, continuing to next page...")
-
-        df_raw = pd.DataFrame(all_records)
-        if not df_raw.empty:
-            df_raw['transaction_type'] = 'Sales Receipt'
-            
-        print(f"✅ Extraction complete. Total {len(all_records)} Sales Receipt records found.")
-        return df_raw
-
-    def fetch_qbo_invoices_raw(access_token, COMPANY_ID, base_url, product_name):
-        all_records = []
-        start_pos = 1
-        max_results = 1000
-        
-        qbo_base_query = "SELECT * FROM Invoice " 
-        
-        print(f"\nStarting raw extraction for INVOICES (FULL FETCH for filtering)...")
-
-        while True: 
-            qbo_query = f"{qbo_base_query} STARTPOSITION {start_pos} MAXRESULTS {max_results}"
-            api_url = f"{base_url}/v3/company/{COMPANY_ID}/query" 
-
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Accept': 'application/json',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-
-            response = requests.get(api_url, headers=headers, params={'query': qbo_query})
-            
-            if response.status_code != 200:
-                print(f"❌ API Error {response.status_code}: {response.text}")
-                raise Exception("QBO API Request Failed during Invoice fetch.")
-
-            data = response.json()
-            invoices = data.get('QueryResponse', {}).get('Invoice', [])
-            
-            if not invoices:
-                print("No more invoices found. Ending fetch.")
-                break 
-
-            all_records.extend(invoices)
-            
-            if len(invoices) < max_results: 
-                print(f"Last page reached. Total {len(all_records)} invoices.")
-                break
-            
-            start_pos += max_results
-            print(f"Fetched {len(all_records)} total invoice records, continuing to next page...")
-
-        df_raw = pd.DataFrame(all_records)
-        
-        if not df_raw.empty:
-            df_raw['transaction_type'] = 'Invoice'
-
-        print(f"✅ Extraction complete. Total {len(all_records)} Invoice records retrieved for filtering.")
-        return df_raw
-
-    def get_item_name(line):
-        if isinstance(line, dict) and line.get('SalesItemLineDetail'):
-            name = line['SalesItemLineDetail'].get('ItemRef', {}).get('name')
-            if name:
-                return str(name).strip() 
+    QBO_PAGE_SIZE = 1000
+    api_url = f"{env_base}/v3/company/{COMPANY_ID}/query"
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+    async def _run_query(session, semaphore, qbo_query, max_retries=5):
+        async with semaphore:
+            for attempt in range(max_retries):
+                async with session.get(api_url, params={'query': qbo_query}) as response:
+                    body = await response.read()
+
+                    # QBO throttles bursts with 429s; back off exponentially
+                    # on those and on transient 5xx instead of failing the run.
+                    if response.status in RETRYABLE_STATUSES and attempt < max_retries - 1:
+                        delay = 0.5 * (2 ** attempt)
+                        print(f"⚠️ QBO returned {response.status}; retrying in {delay:.1f}s...")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    if response.status != 200:
+                        print(f"\n🚨 API REQUEST FAILED DETAILS 🚨")
+                        print(f"Status Code: {response.status}")
+                        print(f"Response Body: {body.decode(errors='replace')}")
+                        print("-----------------------------------")
+                        raise Exception("QBO API Request Failed.")
+
+                    # orjson parses the multi-MB page payloads in C, well ahead
+                    # of the stdlib tokenizer.
+                    return orjson.loads(body)
+
+    async def _resolve_item_id(session, semaphore):
+        """Resolves TARGET_PRODUCT to its QBO Item Id (None if the lookup fails)."""
+        # Item names don't carry the 'Category:' prefix — query on the leaf.
+        item_name = TARGET_PRODUCT.rsplit(':', 1)[-1].strip().replace("'", "\\'")
+        try:
+            data = await _run_query(
+                session, semaphore, f"SELECT Id FROM Item WHERE Name = '{item_name}'"
+            )
+            items = data.get('QueryResponse', {}).get('Item', [])
+            if items:
+                return items[0]['Id']
+            print(f"⚠️ No QBO Item named '{item_name}' found; falling back to client-side filtering.")
+        except Exception as e:
+            print(f"⚠️ Item lookup failed ({e}); falling back to client-side filtering.")
         return None
 
-    def process_and_filter_df(df_raw, target_product_clean):
-        
-        # Define the schema for empty DataFrames
-        EMPTY_COLS = ['Id', 'customer_name', 'transaction_date', 'item_name_raw', 'transaction_type', 'Amount']
-        
-        if df_raw.empty:
-            return pd.DataFrame(columns=EMPTY_COLS) 
-
-        # 1. Flatten Header Data
-        df_raw['customer_name'] = df_raw['CustomerRef'].apply(lambda x: x.get('name') if isinstance(x, dict) else None)
-        df_raw['transaction_date'] = pd.to_datetime(df_raw['TxnDate'], errors='coerce').dt.date
-
-        # 2. Explode the line items
-        df_lines = df_raw.explode('Line', ignore_index=True) 
-
-        # 3. Extract Item Name and Apply Filter 
-        df_lines['item_name_raw'] = df_lines['Line'].apply(get_item_name) 
-        df_lines['item_name_lower'] = df_lines['item_name_raw'].apply(clean_and_lower) # Uses the global clean_and_lower
-        
-        # ---
-        # --- 
-        # --- CRITICAL FIX: The filter is now active ---
-        # --- 
-        # ---
-        df_product_lines = df_lines[df_lines['item_name_lower'] == target_product_clean].copy()
-        
-        # Check 2: If the filtered result is empty, return an empty DataFrame with final schema
-        if df_product_lines.empty:
-            return pd.DataFrame(columns=EMPTY_COLS)
-        
-        # 4. Add the line-item Amount column
-        # This key ('Amount') is the only one guaranteed to exist on the line item
-        df_product_lines['Amount'] = df_product_lines['Line'].apply(lambda x: x.get('Amount') if isinstance(x, dict) else 0)
-        
-        # 5. Return the filtered DataFrame with the required final columns
-        return df_product_lines[['Id', 'customer_name', 'transaction_date', 'item_name_raw', 'transaction_type', 'Amount']].copy()
-
-
-    # --- EXECUTION: Runs both extraction functions ---
-    print("Checkpoint A: Starting Sales Receipts Fetch")
-    df_receipts_raw = fetch_qbo_sales_receipts_raw(access_token, COMPANY_ID, env_base, TARGET_PRODUCT)
-    print("Checkpoint B: Sales Receipts Fetch Complete")
+    async def _fetch_entity(session, semaphore, entity, item_id=None, since=None):
+        """Fetches every page of one QBO entity with all pages in flight at once."""
+        print(f"\nStarting raw extraction for {entity} records...")
+
+        # Server-side filters: the target Item Id narrows to transactions
+        # that contain the product, and the last-sync cutoff narrows to ones
+        # QBO touched since the previous run.
+        predicates = []
+        if item_id:
+            predicates.append(f"Line.SalesItemLineDetail.ItemRef = '{item_id}'")
+        if since:
+            predicates.append(f"MetaData.LastUpdatedTime >= '{since}'")
+        where_clause = f" WHERE {' AND '.join(predicates)}" if predicates else ""
+
+        try:
+            count_data = await _run_query(
+                session, semaphore, f"SELECT COUNT(*) FROM {entity}{where_clause}"
+            )
+        except Exception:
+            if not item_id:
+                raise
+            # Realm rejected the line-item predicate (QBO only guarantees
+            # filtering on top-level fields) — retry with only the cutoff and
+            # let the client-side product filter do the narrowing.
+            print(f"⚠️ Server-side item filter rejected for {entity}; retrying unfiltered.")
+            predicates = [p for p in predicates if not p.startswith('Line.')]
+            where_clause = f" WHERE {' AND '.join(predicates)}" if predicates else ""
+            count_data = await _run_query(
+                session, semaphore, f"SELECT COUNT(*) FROM {entity}{where_clause}"
+            )
+        total = count_data.get('QueryResponse', {}).get('totalCount', 0)
+        num_pages = max(1, math.ceil(total / QBO_PAGE_SIZE))
+        print(f"Found {total} {entity} records across {num_pages} page(s).")
+
+        async def _fetch_page(start_pos):
+            # Only the fields the flatten pass reads — SELECT * ships dozens
+            # of extra fields (MetaData, addresses, LinkedTxn, ...) per record
+            # that would just be parsed and dropped.
+            qbo_query = (
+                f"SELECT Id, TxnDate, CustomerRef, Line FROM {entity}{where_clause} "
+                f"STARTPOSITION {start_pos} MAXRESULTS {QBO_PAGE_SIZE}"
+            )
+            data = await _run_query(session, semaphore, qbo_query)
+            return data.get('QueryResponse', {}).get(entity, [])
+
+        pages = await asyncio.gather(
+            *[_fetch_page(1 + i * QBO_PAGE_SIZE) for i in range(num_pages)]
+        )
+        records = list(itertools.chain.from_iterable(pages))
+        print(f"✅ Extraction complete. Total {len(records)} {entity} records found.")
+        return records
+
+    async def _fetch_all_entities():
+        # Eight in-flight requests stays under QBO's per-realm throttle while
+        # overlapping every page's round-trip latency.
+        semaphore = asyncio.Semaphore(8)
+        # One pooled keep-alive session for the whole run: every page reuses
+        # warm TLS connections instead of paying ~3 RTTs of handshake each.
+        connector = aiohttp.TCPConnector(limit=16)
+        async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+            # Full refreshes filter server-side by Item Id. Incremental runs
+            # must not: the delta has to include every transaction QBO
+            # touched since the checkpoint — including ones edited to no
+            # longer contain the product — so the merge can delete their
+            # stale rows. The delta is small, so unfiltered is cheap.
+            item_id = None if last_sync else await _resolve_item_id(session, semaphore)
+            return await asyncio.gather(
+                _fetch_entity(session, semaphore, 'SalesReceipt', item_id, last_sync),
+                _fetch_entity(session, semaphore, 'Invoice', item_id, last_sync),
+            )
+
+    FLAT_COLS = ['Id', 'customer_name', 'transaction_date', 'item_name_raw', 'transaction_type', 'Amount']
+
+    def flatten_and_filter(records, transaction_type):
+        """One pass over raw QBO records: emits parallel column lists per matching line.
+
+        Accumulating columns (structure-of-arrays) instead of a list of row
+        dicts means the DataFrame constructor gets ready-made columns — no
+        per-row dict allocation and no column re-assembly from records.
+        """
+        ids, customers, dates, items, amounts = [], [], [], [], []
+        # Bind everything the inner loop touches to locals: global and
+        # attribute lookups are the bulk of the interpreter overhead left in
+        # this loop once the per-line work is just dict gets and appends.
+        ids_append = ids.append
+        customers_append = customers.append
+        dates_append = dates.append
+        items_append = items.append
+        amounts_append = amounts.append
+        is_target = _is_target_product
+        for r in records:
+            customer_name = (r.get('CustomerRef') or {}).get('name')
+            txn_id = r.get('Id')
+            txn_date = r.get('TxnDate')
+            for line in r.get('Line', []):
+                detail = line.get('SalesItemLineDetail')
+                if not detail:
+                    continue
+                name = detail.get('ItemRef', {}).get('name')
+                if name is None or not is_target(name):
+                    continue
+                ids_append(txn_id)
+                customers_append(customer_name)
+                dates_append(txn_date)
+                items_append(str(name).strip())
+                amounts_append(line.get('Amount') or 0.0)
+        return ids, customers, dates, items, amounts, transaction_type
+
+    def build_filtered_df(columns):
+        ids, customers, dates, items, amounts, transaction_type = columns
+        if not ids:
+            return pd.DataFrame(columns=FLAT_COLS)
+        return pd.DataFrame({
+            'Id': ids,
+            'customer_name': customers,
+            # Explicit format skips per-value format sniffing and cache=True
+            # reuses parses for repeated date strings; stays datetime64 so
+            # later steps keep vectorizing (date-ified only at the load).
+            'transaction_date': pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce', cache=True),
+            'item_name_raw': items,
+            'transaction_type': transaction_type,
+            'Amount': np.asarray(amounts, dtype=np.float64),
+        })
 
-    print("Checkpoint C: Starting Invoices Fetch")
-    df_invoices_raw = fetch_qbo_invoices_raw(access_token, COMPANY_ID, env_base, TARGET_PRODUCT)
-    print("Checkpoint D: Invoices Fetch Complete")
+    # --- EXECUTION: Both entities and all their pages fetched concurrently ---
+    print("Checkpoint A/C: Starting Sales Receipts + Invoices Fetch (async)")
+    receipt_records, invoice_records = asyncio.run(_fetch_all_entities())
+    print("Checkpoint B/D: Sales Receipts + Invoices Fetch Complete")
+
+    if last_sync and not receipt_records and not invoice_records:
+        # Quiet day: QBO touched nothing since the checkpoint. Skip the
+        # flatten/load/merge entirely — but still advance the high-water
+        # mark so the window doesn't grow run over run.
+        success_message = "No QBO changes since the last sync; nothing to load."
+        print(f"✅ {success_message}")
+        if QB_SYNC_STATE_SECRET:
+            update_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SYNC_STATE_SECRET, run_started_at)
+        return success_message, 200
 
 
-    # --- Process Each DataFrame Separately and Filter ---
+    # --- Flatten and Filter Each Entity ---
     print("Checkpoint E: Starting Filtering (Receipts)")
-    df_filtered_receipts = process_and_filter_df(df_receipts_raw, TARGET_PRODUCT_CLEAN)
+    df_filtered_receipts = build_filtered_df(flatten_and_filter(receipt_records, 'Sales Receipt'))
     print("Checkpoint F: Starting Filtering (Invoices)")
-    df_filtered_invoices = process_and_filter_df(df_invoices_raw, TARGET_PRODUCT_CLEAN)
+    df_filtered_invoices = build_filtered_df(flatten_and_filter(invoice_records, 'Invoice'))
     print("Checkpoint G: Filtering Complete. Starting Concat.")
 
 
@@ -303,27 +417,20 @@ def run_pipeline(request=None):
         df_payments_final = pd.DataFrame(columns=['transaction_id', 'customer_name', 'transaction_date', 'product_name', 'total_amount', 'transaction_type'])
 
     else:
-        # Concatenate the standardized DataFrames
-        df_combined_filtered = pd.concat(dfs_to_concat, ignore_index=True)
-
-        # --- Final Selection and Rename ---
-        amount_key = 'Amount' # Use the line-item amount key
-        
-        df_payments_final = df_combined_filtered[[
-            'Id', 
-            'customer_name',
-            'transaction_date',
-            'item_name_raw', 
-            'transaction_type', 
-            amount_key, 
-        ]].rename(columns={
-            'Id': 'transaction_id', 
-            amount_key: 'total_amount', 
-            'item_name_raw': 'product_name' 
+        # Both frames share FLAT_COLS exactly, so one concat + rename covers
+        # the combine/select/rename steps without intermediate copies.
+        df_payments_final = pd.concat(
+            dfs_to_concat, ignore_index=True, copy=False
+        ).rename(columns={
+            'Id': 'transaction_id',
+            'Amount': 'total_amount',
+            'item_name_raw': 'product_name'
         })
-        
-        # Final Cleaning
-        df_payments_final['total_amount'] = pd.to_numeric(df_payments_final['total_amount'], errors='coerce')
+
+        # Final Cleaning — downcast halves the amount column vs float64.
+        df_payments_final['total_amount'] = pd.to_numeric(
+            df_payments_final['total_amount'], errors='coerce', downcast='float'
+        )
 
     print("✅ Data transformation complete.")
 
@@ -336,7 +443,7 @@ def run_pipeline(request=None):
     print("Attempting BigQuery Authentication...") # Debug print
     try:
         # UPDATED: No file path needed. It automatically uses GOOGLE_APPLICATION_CREDENTIALS
-        bq_client = bigquery.Client() 
+        bq_client = _get_bq_client()
         print("✅ BigQuery Client authenticated.")
     except Exception as e:
         # UPDATED: Print the error so it shows in Cloud Run logs!
@@ -348,17 +455,94 @@ def run_pipeline(request=None):
     DATASET_ID = 'quickbooks_data'  
     TABLE_ID = 'wahs_qbo_sales' 
     table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
-    job_config = bigquery.LoadJobConfig(write_disposition='WRITE_TRUNCATE') 
+    # Serialize to an in-memory Parquet buffer ourselves (snappy-compressed,
+    # columnar) and hand BigQuery the bytes with a fixed schema, instead of
+    # letting load_table_from_dataframe pick its own serialization settings
+    # and re-derive the schema from the frame on every run.
+    # Incremental runs land the delta in a staging table and then swap the
+    # touched transactions into the serving table in one query — re-edits
+    # replace their old rows instead of double-counting, and voided
+    # transactions get deleted. Full runs keep truncate-and-replace.
+    staging_ref = f"{table_ref}_staging"
+    load_target = staging_ref if last_sync else table_ref
+    job_config = bigquery.LoadJobConfig(
+        write_disposition='WRITE_TRUNCATE',
+        source_format=bigquery.SourceFormat.PARQUET,
+        schema=WAHS_SALES_SCHEMA,
+    )
 
     try:
-        df_to_load = df_payments_final 
-
-        print(f"Starting upload to {table_ref}...") # Debug print
-        job = bq_client.load_table_from_dataframe(df_to_load, table_ref, job_config=job_config)
-        job.result() 
-        
-        success_message = f"QuickBooks data loaded successfully! Loaded {job.output_rows} rows."
+        delta_ids = []
+        if last_sync:
+            # The delta was fetched without the item filter, so these ids
+            # cover every touched transaction — matching or not.
+            delta_ids = sorted(
+                {r.get('Id') for r in itertools.chain(receipt_records, invoice_records) if r.get('Id')}
+            )
+
+        if last_sync and df_payments_final.empty:
+            # Transactions were touched, but none still matches the product —
+            # their stale rows just need deleting; nothing to stage.
+            bq_client.query(
+                f"DELETE FROM `{table_ref}` WHERE transaction_id IN UNNEST(@delta_ids)",
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ArrayQueryParameter('delta_ids', 'STRING', delta_ids)
+                    ]
+                ),
+            ).result()
+            success_message = f"Removed {len(delta_ids)} touched transaction(s); no matching rows to load."
+            print(f"\n🚀 {success_message}\n")
+
+            if QB_SYNC_STATE_SECRET:
+                update_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SYNC_STATE_SECRET, run_started_at)
+            return success_message, 200
+
+        # Boundary conversion: the DATE schema field wants date32, so collapse
+        # the datetime64 column only now, on the already-filtered frame.
+        if not df_payments_final.empty:
+            df_payments_final['transaction_date'] = df_payments_final['transaction_date'].dt.date
+
+        buf = io.BytesIO()
+        df_payments_final.to_parquet(buf, engine='pyarrow', compression='snappy', index=False)
+        buf.seek(0)
+
+        print(f"Starting upload to {load_target}...") # Debug print
+        job = bq_client.load_table_from_file(buf, load_target, job_config=job_config)
+        job.result()
+
+        if last_sync:
+            # Replace, don't append: delete every touched transaction, then
+            # insert the staged rows. Wrapped in an explicit transaction —
+            # multi-statement scripts otherwise commit per statement, and a
+            # failed INSERT must not leave the DELETE committed on its own.
+            # Delete+insert rather than MERGE because transaction_id repeats
+            # per matching line item.
+            dedupe_sql = (
+                "BEGIN TRANSACTION;\n"
+                f"DELETE FROM `{table_ref}` WHERE transaction_id IN UNNEST(@delta_ids);\n"
+                f"INSERT INTO `{table_ref}` SELECT * FROM `{staging_ref}`;\n"
+                "COMMIT TRANSACTION;"
+            )
+            bq_client.query(
+                dedupe_sql,
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ArrayQueryParameter('delta_ids', 'STRING', delta_ids)
+                    ]
+                ),
+            ).result()
+            bq_client.delete_table(staging_ref, not_found_ok=True)
+            success_message = f"QuickBooks data loaded successfully! Merged {job.output_rows} delta rows."
+        else:
+            success_message = f"QuickBooks data loaded successfully! Loaded {job.output_rows} rows."
         print(f"\n🚀 {success_message}\n")
+
+        # Advance the high-water mark only after a successful load, so a
+        # failed run is simply re-fetched next time.
+        if QB_SYNC_STATE_SECRET:
+            update_refresh_token(PROJECT_ID_FOR_SECRETS, QB_SYNC_STATE_SECRET, run_started_at)
+
         return success_message, 200
     
     except Exception as e: